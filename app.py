@@ -3,6 +3,7 @@ import os
 import base64
 import re
 import time
+import hashlib
 from datetime import datetime as dt, timezone, timedelta
 
 # Selenium
@@ -13,6 +14,7 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys
+from selenium.common.exceptions import TimeoutException
 from webdriver_manager.chrome import ChromeDriverManager
 from webdriver_manager.core.os_manager import ChromeType
 
@@ -21,35 +23,53 @@ from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+from browser_memory import MemoryGovernor, apply_lean_options
+from calendar_client import CalendarClient, MANAGED_CALENDAR, TRANSPORT_ERRORS, event_id
+from scan_budget import ScanBudget, BudgetExhausted, PAGE_TIMEOUT
+from scan_history import ScanHistory
+from scan_checkpoint import ScanCheckpoint, ScanCancelled
+from ics_feed import IcsFeed, ICS_FILE
+from sync_jobs import JobQueue
 
 # --- ページ設定 ---
 st.set_page_config(page_title="manaba 自動連携ツール", layout="centered")
 
 # --- クラス定義: ロジックの中核 ---
 class ManabaEngine:
-    def __init__(self, user, pw, log_container, progress_bar, credentials):
+    def __init__(self, user, pw, job, credentials, output='calendar', ics_path=ICS_FILE, dedicated=False, reset_calendar=False, time_budget=None, page_timeout=PAGE_TIMEOUT):
         self.user = user
         self.pw = pw
-        self.log_container = log_container
-        self.progress_bar = progress_bar
+        self.job = job  # ログと進捗の書き込み先 (sync_jobs.SyncJob)
         self.credentials = credentials
+        self.output = output  # 'calendar' または 'ics'
+        self.ics_path = ics_path
         self.calendar_id = 'primary'
+        self.dedicated = dedicated  # True: 専用カレンダーに同期
+        self.reset_calendar = reset_calendar
+        self.time_budget = time_budget  # スキャン全体の時間制限 (秒, Noneで無制限)
+        self.page_timeout = page_timeout
+        self.finished_courses = set()  # 最後まで解析できたコース名
+        self.scan_complete = True
         self.sig = "[manaba-auto]"
-        self.logs = []
+        self.driver = None
+        self.cancel_event = job.cancel_event
+        job.on_cancel = self._quit_driver
 
     def log(self, message):
-        """ログを画面に出力"""
-        timestamp = dt.now().strftime("%H:%M:%S")
-        self.logs.append(f"[{timestamp}] {message}")
-        self.log_container.text("\n".join(self.logs))
-        print(f"[{timestamp}] {message}")
+        """ログをジョブに記録 (画面側がポーリングで表示する)"""
+        self.job.log(message)
 
     def update_progress(self, value):
-        """プログレスバーを更新 (0-100)"""
-        self.progress_bar.progress(int(value))
+        """進捗を更新 (0-100)"""
+        self.job.set_progress(value)
 
     def run(self):
-        driver = None
+        self.governor = MemoryGovernor()
+        self.checkpoint = ScanCheckpoint(self.user)
+        self.budget = ScanBudget(self.time_budget)
+        self.history = ScanHistory(self.user)
         try:
             self.log("--- 同期プロセス開始 ---")
             self.update_progress(5)
@@ -57,46 +77,115 @@ class ManabaEngine:
             # STEP1: manabaスキャン
             self.log("【1/2】manabaから課題を取得しています...")
             
-            # ブラウザ設定 (Streamlit Cloud向け)
-            options = Options()
-            options.add_argument("--headless")
-            options.add_argument("--no-sandbox")
-            options.add_argument("--disable-dev-shm-usage")
-            options.add_argument("--disable-gpu")
-            options.add_argument("--window-size=1280,720")
-            options.add_argument("--lang=ja-JP")
-            
-            service = Service(ChromeDriverManager(chrome_type=ChromeType.CHROMIUM).install())
-            driver = webdriver.Chrome(service=service, options=options)
-            
-            tasks, submitted = self.fetch_manaba(driver)
+            self.driver = self._create_driver()
+            tasks, submitted = self.fetch_manaba()
             
-            driver.quit()
-            driver = None
+            self._quit_driver()
 
             self.log(f"-> 未提出課題: {len(tasks)}件、提出済み: {len(submitted)}件を検出")
+            self.log(f"-> {self.governor.summary()}")
+            self.job.memory = self.governor.stats()
             self.update_progress(60)
             
-            # STEP2: カレンダー同期
-            self.log("【2/2】Googleカレンダーと同期しています...")
-            self.sync_calendar(tasks, submitted)
+            # STEP2: カレンダー同期 / ICS出力
+            self._check_cancel()
+            if self.output == 'ics':
+                self.log("【2/2】ICSファイルを書き出しています...")
+                self.export_ics(tasks, submitted)
+            else:
+                self.log("【2/2】Googleカレンダーと同期しています...")
+                self.sync_calendar(tasks, submitted)
+            if self.scan_complete:
+                self.checkpoint.clear()
+            else:
+                # 同期した途中結果は次回再利用しない (残りのコースから先に巡回する)
+                self.checkpoint.mark_synced()
             
             self.update_progress(100)
             self.log("--- すべての工程が完了しました ---")
-            st.success(f"同期完了！ 未提出課題 {len(tasks)}件を整理しました。")
+            self.job.result = f"同期完了！ 未提出課題 {len(tasks)}件を整理しました。"
             
+        except ScanCancelled:
+            self.scan_complete = False
+            self.log("■ 中止しました (解析済みのコースは次回の同期で再利用されます)")
+            self.job.status = 'cancelled'
         except Exception as e:
+            self.scan_complete = False
             self.log(f"✖ エラーが発生しました: {e}")
-            st.error(f"エラー: {e}")
+            if self.checkpoint.courses:
+                self.log(f"  解析済みの {len(self.checkpoint.courses)}コースは次回の同期で再利用されます")
+            self.job.error = str(e)
+            self.job.status = 'error'
         finally:
-            if driver:
+            self._quit_driver()
+            self.history.save(self.scan_complete)
+
+    def _check_cancel(self):
+        if self.cancel_event.is_set():
+            raise ScanCancelled()
+
+    def _quit_driver(self):
+        driver, self.driver = self.driver, None
+        if driver:
+            try:
                 driver.quit()
+            except Exception:
+                pass
+
+    def _create_driver(self):
+        # ブラウザ設定 (Streamlit Cloud向け)
+        options = Options()
+        options.add_argument("--headless")
+        options.add_argument("--no-sandbox")
+        options.add_argument("--disable-dev-shm-usage")
+        options.add_argument("--disable-gpu")
+        options.add_argument("--window-size=1280,720")
+        options.add_argument("--lang=ja-JP")
+        apply_lean_options(options)
+        
+        service = Service(ChromeDriverManager(chrome_type=ChromeType.CHROMIUM).install())
+        return webdriver.Chrome(service=service, options=options)
 
-    def fetch_manaba(self, driver):
+    def _visit(self, url):
+        """
+        ページを開き、ブラウザのメモリ使用量を記録する。
+        読み込みが page_timeout を超えたら一度だけ中断してやり直す。
+        """
+        for attempt in range(2):
+            self._check_cancel()
+            timeout = self.budget.timeout(self.page_timeout)
+            try:
+                self.driver.set_page_load_timeout(timeout)
+                self.driver.get(url)
+                break
+            except TimeoutException:
+                self._check_cancel()
+                if attempt == 1:
+                    raise
+                self.log(f" [遅延] {timeout:.0f}秒以内に読み込めなかったため再試行します")
+                try:
+                    self.driver.execute_script("window.stop();")
+                except Exception:
+                    pass
+            except Exception:
+                self._check_cancel()  # 中止でブラウザが閉じられた
+                raise
+        self.governor.sample(self.driver)
+
+    def _recycle_driver(self):
+        """メモリ上限を超えたブラウザを作り直し、ログインし直す"""
+        self.log(f" [メモリ] {self.governor.last / 1024 / 1024:.0f}MB に達したためブラウザを再起動します")
+        self._quit_driver()
+        self.driver = self._create_driver()
+        self.governor.recycled()
+        self._login()
+
+    def _login(self):
+        driver = self.driver
         auth = base64.b64encode(f"{self.user}:{self.pw}".encode()).decode()
         driver.execute_cdp_cmd("Network.setExtraHTTPHeaders", {"headers": {"Authorization": f"Basic {auth}"}})
         
-        driver.get('https://slms.mi.sanno.ac.jp/ct/home')
+        self._visit('https://slms.mi.sanno.ac.jp/ct/home')
         
         try:
             wait = WebDriverWait(driver, 10)
@@ -105,40 +194,107 @@ class ManabaEngine:
                 driver.find_element(By.NAME, "password").send_keys(self.pw + Keys.ENTER)
         except: pass 
 
+        # 時間切れ (BudgetExhausted) をログイン失敗と区別するため、待ち時間は try の外で決める
+        timeout = self.budget.timeout(self.page_timeout)
         try:
-            WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.CSS_SELECTOR, 'td.course')))
+            WebDriverWait(driver, timeout).until(EC.presence_of_element_located((By.CSS_SELECTOR, 'td.course')))
         except:
+            self._check_cancel()
             raise Exception("manabaへのログインに失敗しました。ID/PWを確認してください。")
 
-        links = driver.find_elements(By.CSS_SELECTOR, 'td.course a[href*="course_"]:not(.courseweekly-fav)')
+    def fetch_manaba(self):
+        self._login()
+
+        links = self.driver.find_elements(By.CSS_SELECTOR, 'td.course a[href*="course_"]:not(.courseweekly-fav)')
         urls = list(dict.fromkeys([l.get_attribute('href') for l in links]))
         
+        # 履歴から未提出課題が出やすいコースを先に回す
+        history = self.history
+        urls = self.checkpoint.order(history.order(urls))
+        if history.full_sweep:
+            self.log(" [全巡回] 今回はすべてのページを確認します")
+        
         results = {}
         submitted_list = []
         targets = [('_report', 'レポート'), ('_query', '小テスト'), ('_survey', 'アンケート')]
+        checkpoint = self.checkpoint
+        self.finished_courses = set()
+        self.scan_complete = True
+        if checkpoint.courses:
+            self.log(f" [再開] 前回の途中結果 ({len(checkpoint.courses)}コース) から再開します")
 
         total = len(urls)
         for i, base_url in enumerate(urls):
             self.update_progress(10 + (i / total * 50))
-            driver.get(base_url)
+            # チェックポイント済みのコースは前回の結果を使う
+            if base_url in checkpoint:
+                saved = checkpoint.get(base_url)
+                for key in saved['tasks']:
+                    results[tuple(key)] = 1
+                submitted_list.extend(saved['submitted'])
+                self.log(f" > 前回の結果を使用: {saved['name']}")
+                self.finished_courses.add(saved['name'])
+                continue
+            
+            if self.budget.exhausted():
+                self.scan_complete = False
+                break
+            
+            # 前のコースでメモリ上限を超えていたら、次のコースの前にブラウザを作り直す
+            if self.governor.over_limit():
+                try:
+                    self._recycle_driver()
+                except Exception as e:
+                    # 再起動・再ログインに失敗しても、解析済みのコースは同期する
+                    self._check_cancel()
+                    self.scan_complete = False
+                    if not isinstance(e, BudgetExhausted):
+                        self.log(f" [メモリ] ブラウザを再起動できませんでした ({e})。解析済みのコースで同期します")
+                    break
+            driver = self.driver
             try:
+                self._visit(base_url)
                 name_elem = driver.find_elements(By.ID, 'coursename')
                 if not name_elem: continue
                 name = name_elem[0].text
                 self.log(f" > 解析中: {name}")
                 
+                course_results = {}
+                course_submitted = []
                 for suffix, label in targets:
-                    driver.get(base_url + suffix)
+                    # これまで一度も課題が無かったページは飛ばす (全巡回の回を除く)
+                    if not history.should_visit(base_url, suffix):
+                        continue
+                    started = time.monotonic()
+                    self._visit(base_url + suffix)
                     rows = driver.find_elements(By.TAG_NAME, 'tr')
+                    dated_rows = 0
                     for row in rows:
                         t = row.text
                         m = re.findall(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}', t)
+                        if m: dated_rows += 1
                         if '未提出' in t and '受付中' in t and m:
                             deadline = sorted(m)[-1]
-                            results[(f"【提出：{label}】{name}", deadline)] = 1
+                            course_results[(f"【提出：{label}】{name}", deadline)] = 1
                         elif any(x in t for x in ['提出済み', '回答済み', '済']):
-                            submitted_list.append(f"{label}】{name}")
-            except: continue
+                            course_submitted.append(f"{label}】{name}")
+                    history.record_page(base_url, suffix, dated_rows, time.monotonic() - started)
+                
+                # コースを最後まで解析できたら結果を確定してチェックポイントに保存
+                results.update(course_results)
+                submitted_list.extend(course_submitted)
+                checkpoint.save_course(base_url, name, list(course_results), course_submitted)
+                self.finished_courses.add(name)
+                history.record_course(base_url, name, len(course_results))
+            except Exception as e:
+                self._check_cancel()
+                self.scan_complete = False
+                if isinstance(e, BudgetExhausted) or self.budget.exhausted():
+                    break
+                continue
+        
+        if self.budget.exhausted():
+            self.log(f" [時間切れ] {len(self.finished_courses)}/{total}コースの結果で同期します (未完了のコースの予定は削除しません)")
         
         final_tasks = [(t, dt.strptime(d, '%Y-%m-%d %H:%M').strftime("%Y-%m-%dT%H:%M:00")) for t, d in results.keys()]
         return final_tasks, list(set(submitted_list))
@@ -146,13 +302,37 @@ class ManabaEngine:
     def _get_calendar_service(self):
         return build('calendar', 'v3', credentials=self.credentials)
 
+    def _prepare_calendar(self, api):
+        """専用カレンダーを使う場合はそのIDを解決する (初回は作成してprimaryから移行)"""
+        if not self.dedicated:
+            return
+        cal_id = api.find_calendar(self.sig)
+        if cal_id is None:
+            cal_id = api.create_calendar(MANAGED_CALENDAR, self.sig)
+            self.log(f">> 専用カレンダー「{MANAGED_CALENDAR}」を作成しました")
+            
+            # 作成時に一度だけ、メインカレンダーに残っている [manaba-auto] の予定を移行
+            # (sync_calendar と同じく過去60日より前の予定は対象外)
+            time_min = (dt.now(timezone.utc) - timedelta(days=60)).isoformat()
+            moved = api.migrate_events('primary', cal_id, self.sig, time_min)
+            if moved:
+                self.log(f">> メインカレンダーから {moved}件の予定を移行しました")
+        elif self.reset_calendar and not self.scan_complete:
+            # 解析できなかったコースの予定まで消えてしまうため、途中で打ち切ったスキャンでは作り直さない
+            self.log(">> スキャンが完了していないため、専用カレンダーの作り直しをスキップしました")
+        elif self.reset_calendar:
+            cal_id = api.reset_calendar(cal_id, MANAGED_CALENDAR, self.sig)
+            self.log(f">> 専用カレンダー「{MANAGED_CALENDAR}」を作り直しました")
+        self.calendar_id = cal_id
+
     def sync_calendar(self, tasks, submitted_titles):
         service = self._get_calendar_service()
+        api = CalendarClient(service, self.log)
+        self._prepare_calendar(api)
         now = dt.now(timezone.utc)
         
         self.log(">> 既存の予定を確認中...")
-        events_result = service.events().list(calendarId=self.calendar_id, timeMin=(now - timedelta(days=60)).isoformat(), singleEvents=True).execute()
-        events = events_result.get('items', [])
+        events = api.list_all(service.events().list, calendarId=self.calendar_id, timeMin=(now - timedelta(days=60)).isoformat(), singleEvents=True)
         
         processed_keys = {}
         for ev in events:
@@ -163,11 +343,17 @@ class ManabaEngine:
             ev_dt_str = ev['start'].get('dateTime')
             if ev_dt_str:
                 ev_dt = dt.fromisoformat(ev_dt_str.replace('Z', '+00:00'))
-                if category_with_name in submitted_titles or ev_dt < now:
+                # (時間切れで解析できなかったコースの予定は提出済み扱いにしない)
+                if (category_with_name in submitted_titles and not self._is_unfinished(summary)) or ev_dt < now:
                     try:
-                        service.events().delete(calendarId=self.calendar_id, eventId=ev['id']).execute()
+                        api.execute(service.events().delete(calendarId=self.calendar_id, eventId=ev['id']))
                         self.log(f" [削除済/期限切れ] {summary}")
-                    except: pass
+                    except HttpError as e:
+                        if e.resp.status not in (404, 410):
+                            self.log(f" [削除失敗] {summary}: {e}")
+                    except TRANSPORT_ERRORS as e:
+                        # 再試行しても通信できなかった予定は次回の同期で削除する
+                        self.log(f" [削除失敗] {summary}: {e}")
                     continue
             processed_keys[(summary.split('】')[-1], start_iso)] = ev['id']
 
@@ -180,10 +366,77 @@ class ManabaEngine:
                     'colorId': '11',
                     'reminders': {'useDefault': False, 'overrides': [{'method': 'popup', 'minutes': 60}]}
                 }
-                service.events().insert(calendarId=self.calendar_id, body=event).execute()
+                event['id'] = event_id(title, deadline)
+                api.insert_event(self.calendar_id, event)
                 self.log(f" [新規追加] {title}")
             else:
                  self.log(f" [継続] {title}")
+        
+        self.log(f">> {api.summary()}")
+
+    def _is_unfinished(self, title):
+        """途中で打ち切ったスキャンで、解析できなかったコースの予定か"""
+        return not self.scan_complete and title.split('】')[-1] not in self.finished_courses
+
+    def export_ics(self, tasks, submitted_titles):
+        feed = IcsFeed(self.ics_path, sig=self.sig)
+        added, kept, removed = feed.update(tasks, submitted_titles, keep=self._is_unfinished)
+        self.log(f" [ICS] 追加 {added}件 / 継続 {kept}件 / 削除 {removed}件")
+
+# --- ジョブキュー (全セッション共有) ---
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
+
+def show_job(job):
+    """実行中/待機中のジョブの状態を表示し、終わるまでポーリングする"""
+    queue = get_job_queue()
+    st.subheader("実行ログ")
+    if job.status == 'queued':
+        st.info(f"順番待ち: あと {queue.position(job) + 1}番目 (完了まで約 {int(queue.eta(job))}秒)")
+    elif job.status == 'running':
+        st.info(f"実行中... (残り約 {int(queue.eta(job))}秒)")
+    st.progress(job.progress)
+    with job.lock:
+        st.text("\n".join(job.logs))
+
+    if job.active:
+        if st.button("中止"):
+            job.cancel()
+        time.sleep(1)
+        st.rerun()
+    elif job.status == 'cancelled':
+        st.warning("中止しました。解析済みのコースは次回の同期で再利用されます。")
+    elif job.status == 'error':
+        st.error(f"エラー: {job.error}")
+    else:
+        st.success(job.result)
+        if job.memory:
+            st.caption(f"ブラウザのメモリ: ピーク {job.memory['peak_mb']:.0f}MB / 平均 {job.memory['avg_mb']:.0f}MB / 再起動 {job.memory['restarts']}回")
+        ics_path = getattr(job, 'ics_path', None)
+        if ics_path and os.path.exists(ics_path):
+            with open(ics_path, 'rb') as f:
+                st.download_button("ICSファイルをダウンロード", f.read(), file_name=ICS_FILE, mime="text/calendar")
+
+def show_owned_job(job):
+    """
+    このセッションで開始したジョブだけ表示する。
+    URLの ?job= から復元したジョブは、開始時と同じmanabaのID・パスワードを入力するまで見せない。
+    """
+    if job.id not in st.session_state.owned_jobs:
+        st.subheader("前回の同期")
+        st.caption("同期を開始したときのmanabaのIDとパスワードを入力すると、状況を確認できます。")
+        with st.form("verify_job_form"):
+            verify_id = st.text_input("manaba ユーザーID", key="verify_user_id")
+            verify_pw = st.text_input("パスワード", type="password", key="verify_password")
+            verified = st.form_submit_button("確認")
+        if not verified:
+            return
+        if not job.is_owner(verify_id, verify_pw):
+            st.error("IDまたはパスワードが一致しません")
+            return
+        st.session_state.owned_jobs.add(job.id)
+    show_job(job)
 
 # --- メイン画面 ---
 st.title("manaba 自動連携ツール (Web版)")
@@ -194,6 +447,19 @@ SCOPES = ['https://www.googleapis.com/auth/calendar']
 
 if 'credentials' not in st.session_state:
     st.session_state.credentials = None
+if 'job_id' not in st.session_state:
+    # リロードするとセッションが作り直されるため、URLに残したジョブIDから復元する
+    st.session_state.job_id = st.query_params.get("job")
+if 'owned_jobs' not in st.session_state:
+    # このセッションで開始した、または本人確認が済んだジョブのID
+    st.session_state.owned_jobs = set()
+
+job = get_job_queue().get(st.session_state.job_id) if st.session_state.job_id else None
+if st.session_state.job_id and not job:
+    # 保持期間を過ぎた、またはサーバーが再起動したジョブ
+    st.session_state.job_id = None
+    if "job" in st.query_params:
+        del st.query_params["job"]
 
 def get_flow():
     # secrets.toml が正しく読み込めているかチェック
@@ -236,33 +502,62 @@ if "code" in st.query_params and not st.session_state.credentials:
     except Exception as e:
         st.error(f"認証エラー: {e}")
 
-# 2. 未ログイン時：ログインボタンを表示
-if not st.session_state.credentials:
-    st.warning("まずはGoogleカレンダーへのアクセスを許可してください。")
+# 2. 未ログイン時：ログインボタンを表示 (ICSファイルの出力はログインせずに使える)
+logged_in = bool(st.session_state.credentials)
+if not logged_in:
+    st.warning("Googleカレンダーに同期するには、Googleカレンダーへのアクセスを許可してください。")
     flow = get_flow()
     auth_url, _ = flow.authorization_url(prompt='consent')
     st.link_button("Googleでログイン", auth_url)
-
-# 3. ログイン済み：manabaフォームを表示
+    st.caption("ICSファイルへの出力だけなら、ログインせずに使えます。")
 else:
     st.success("Googleログイン済み")
     if st.button("ログアウト"):
         st.session_state.credentials = None
         st.rerun()
 
-    with st.form("login_form"):
-        user_id = st.text_input("manaba ユーザーID")
-        password = st.text_input("パスワード", type="password")
-        submitted = st.form_submit_button("同期を開始")
-
-    if submitted:
-        if not user_id or not password:
-            st.error("IDとパスワードを入力してください")
-        else:
-            st.subheader("実行ログ")
-            progress_bar = st.progress(0)
-            log_area = st.empty()
-            
-            # 認証情報を渡してエンジンを起動
-            engine = ManabaEngine(user_id, password, log_area, progress_bar, st.session_state.credentials)
+# 3. manabaフォームを表示
+# 「作り直す」は1回限り。前回の送信でチェックされていたら外しておく
+if st.session_state.pop('clear_reset_calendar', False):
+    st.session_state.reset_calendar = False
+
+with st.form("login_form"):
+    user_id = st.text_input("manaba ユーザーID")
+    password = st.text_input("パスワード", type="password")
+    if logged_in:
+        output_label = st.radio("出力先", ["Googleカレンダー", "ICSファイル"], horizontal=True)
+        dedicated = st.checkbox(f"専用カレンダー「{MANAGED_CALENDAR}」に同期")
+        reset_calendar = st.checkbox("専用カレンダーを作り直す", key="reset_calendar")
+    else:
+        output_label = st.radio("出力先", ["ICSファイル"], horizontal=True)
+        dedicated = reset_calendar = False
+    time_budget = st.number_input("スキャンの時間制限 (秒、0で無制限)", min_value=0, value=0, step=30)
+    submitted = st.form_submit_button("同期を開始")
+
+if submitted:
+    if not user_id or not password:
+        st.error("IDとパスワードを入力してください")
+    elif job and job.active and job.id in st.session_state.owned_jobs:
+        st.warning("前回の同期がまだ実行中です")
+    else:
+        # ユーザーごとにICSファイルを分ける
+        output = 'ics' if output_label == "ICSファイル" else 'calendar'
+        ics_path = f"manaba_{hashlib.sha1(user_id.encode()).hexdigest()[:12]}.ics"
+        # ICSのみのときは認証情報を使わない (未ログインならNone)
+        credentials = st.session_state.credentials if output == 'calendar' else None
+        
+        # 認証情報を渡してエンジンをバックグラウンドで起動
+        def target(job):
+            engine = ManabaEngine(user_id, password, job, credentials, output=output, ics_path=ics_path, dedicated=dedicated, reset_calendar=reset_calendar and dedicated, time_budget=time_budget or None)
             engine.run()
+        
+        job = get_job_queue().submit(target, user_id, password)
+        st.session_state.owned_jobs.add(job.id)
+        st.session_state.clear_reset_calendar = True
+        job.ics_path = ics_path if output == 'ics' else None
+        st.session_state.job_id = job.id
+        st.query_params["job"] = job.id
+
+# ログインし直す前でも、リロード前に始めた同期の状況は確認できるようにする
+if job:
+    show_owned_job(job)
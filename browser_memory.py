@@ -0,0 +1,147 @@
+import os
+
+try:
+    import psutil
+except ImportError:  # psutil が無い環境では /proc を直接読む (Linuxのみ)
+    psutil = None
+
+# --- Chromiumのメモリ監視 ---
+# ブラウザのプロセスツリー全体の使用メモリ (USS/PSS) がこれを超えたらドライバを作り直す (MB)
+MEMORY_LIMIT_MB = int(os.environ.get('MANABA_MEMORY_LIMIT_MB', '500'))
+
+# メモリ消費を抑える起動オプション
+LEAN_CHROME_ARGS = [
+    '--disable-extensions',
+    '--disable-background-networking',
+    '--disable-component-update',
+    '--disable-default-apps',
+    '--disable-sync',
+    '--no-first-run',
+    '--mute-audio',
+    '--renderer-process-limit=2',
+    '--disable-site-isolation-trials',
+    '--disable-features=Translate,BackForwardCache,MediaRouter,OptimizationHints',
+    '--js-flags=--max-old-space-size=128',
+    '--blink-settings=imagesEnabled=false',
+    '--disk-cache-size=1048576',
+]
+
+
+def apply_lean_options(options):
+    for arg in LEAN_CHROME_ARGS:
+        options.add_argument(arg)
+    # 画像を読み込まない
+    options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+    return options
+
+
+def _proc_pss(pid, page):
+    """/proc/<pid>/smaps_rollup の Pss (バイト)。読めない古いカーネルでは stat の RSS で代用する"""
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'rb') as f:
+            for line in f:
+                if line.startswith(b'Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            return int(f.read().rsplit(b')', 1)[1].split()[21]) * page
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def _tree_pss_proc(root_pid):
+    """psutil無しで /proc から子孫プロセスを含むPSSを合計する"""
+    page = os.sysconf('SC_PAGE_SIZE')
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as f:
+                fields = f.read().rsplit(b')', 1)[1].split()
+            children.setdefault(int(fields[1]), []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    total, stack = 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        total += _proc_pss(pid, page)
+        stack.extend(children.get(pid, []))
+    return total
+
+
+def tree_memory(root_pid):
+    """
+    root_pid とその子孫プロセスの使用メモリ合計 (バイト)。取得できなければNone。
+    Chromiumのプロセス同士は共有ライブラリ等のページを共有しているため、
+    RSSを足すと二重に数えてしまう。psutilではUSS (そのプロセスだけのページ)、
+    /procではPSS (共有ページを按分したもの) を合計する。
+    """
+    if psutil is not None:
+        try:
+            proc = psutil.Process(root_pid)
+            procs = [proc] + proc.children(recursive=True)
+        except psutil.Error:
+            return None
+        total = 0
+        for p in procs:
+            try:
+                total += p.memory_full_info().uss
+            except psutil.AccessDenied:
+                # smaps を読めない環境ではRSSで代用する
+                try:
+                    total += p.memory_info().rss
+                except psutil.Error:
+                    pass
+            except psutil.Error:
+                pass
+        return total
+    if os.path.isdir('/proc'):
+        return _tree_pss_proc(root_pid)
+    return None
+
+
+class MemoryGovernor:
+    """ページ読み込みごとにブラウザの使用メモリ (USS/PSS) を計測し、しきい値超過を知らせる"""
+    def __init__(self, limit_mb=MEMORY_LIMIT_MB):
+        self.limit = limit_mb * 1024 * 1024
+        self.samples = 0
+        self.total = 0
+        self.peak = 0
+        self.restarts = 0
+        self.last = 0
+
+    def sample(self, driver):
+        try:
+            pid = driver.service.process.pid
+        except AttributeError:
+            return None
+        used = tree_memory(pid)
+        if used is None:
+            return None
+        self.last = used
+        self.samples += 1
+        self.total += used
+        self.peak = max(self.peak, used)
+        return used
+
+    def over_limit(self):
+        return self.last > self.limit
+
+    def recycled(self):
+        self.restarts += 1
+        self.last = 0
+
+    def summary(self):
+        if not self.samples:
+            return "メモリ: 計測できませんでした"
+        mb = 1024 * 1024
+        return (f"メモリ: ピーク {self.peak / mb:.0f}MB / 平均 {self.total / self.samples / mb:.0f}MB"
+                f" / 再起動 {self.restarts}回 (上限 {self.limit / mb:.0f}MB)")
+
+    def stats(self):
+        mb = 1024 * 1024
+        avg = self.total / self.samples / mb if self.samples else 0
+        return {'peak_mb': self.peak / mb, 'avg_mb': avg, 'restarts': self.restarts}
@@ -0,0 +1,210 @@
+import json
+import base64
+import hashlib
+import http.client
+import random
+import threading
+import time
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+# --- Google Calendar API 呼び出し層 (レート制限・リトライ) ---
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# 一時的なレート制限のみ (quotaExceeded は上限到達なので待っても回復しない)
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+# 通信エラー (タイムアウト・接続リセット等) も同じバックオフで再試行する
+TRANSPORT_ERRORS = (OSError, http.client.HTTPException, httplib2.HttpLib2Error)
+
+# Cloud Consoleの「1分あたりのクエリ数」のクォータをそのまま設定する
+PROJECT_QUERIES_PER_MINUTE = 300
+# トークンバケットは1秒単位で補充するため、分あたりの値を秒あたりに換算する
+PROJECT_QPS = PROJECT_QUERIES_PER_MINUTE / 60
+PROJECT_BURST = 10
+
+# 専用カレンダーの表示名
+MANAGED_CALENDAR = 'manaba'
+
+
+class TokenBucket:
+    """クライアント側のトークンバケット (rate: 1秒あたりの補充数, capacity: バースト上限)"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """トークンを1つ取得し、待った秒数を返す"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+# プロセス内の全ユーザーで共有するバケット (Streamlit版では複数セッションが同時に叩くため)
+_project_bucket = None
+_project_bucket_lock = threading.Lock()
+
+
+def project_bucket():
+    global _project_bucket
+    with _project_bucket_lock:
+        if _project_bucket is None:
+            _project_bucket = TokenBucket(PROJECT_QPS, PROJECT_BURST)
+        return _project_bucket
+
+
+def event_id(title, deadline):
+    """
+    課題ごとに決まる予定ID (base32hex)。
+    挿入を再試行しても同じIDになるため、1回目が実は保存されていても重複しない。
+    """
+    digest = hashlib.sha1(f"{title}|{deadline}".encode('utf-8')).digest()
+    return base64.b32hexencode(digest).decode().lower().rstrip('=')
+
+
+def _error_reason(error):
+    try:
+        body = json.loads(error.content.decode('utf-8'))
+        errors = body.get('error', {}).get('errors', [])
+        return errors[0].get('reason', '') if errors else ''
+    except (ValueError, AttributeError, UnicodeDecodeError):
+        return ''
+
+
+class CalendarClient:
+    """
+    Calendar APIのリクエストをトークンバケット経由で実行し、
+    429/rateLimitExceeded/5xx は Retry-After を尊重した指数バックオフで、
+    通信エラーは同じ指数バックオフで再試行する。
+    """
+    def __init__(self, service, log_func=None, bucket=None, max_retries=6, base_delay=1.0, max_delay=64.0):
+        self.service = service
+        self.log = log_func or (lambda msg: None)
+        self.bucket = bucket or project_bucket()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {'calls': 0, 'retries': 0, 'throttle_sec': 0.0, 'errors': 0}
+
+    def _is_retryable(self, error):
+        status = error.resp.status
+        if status in RETRY_STATUS:
+            return True
+        return status == 403 and _error_reason(error) in RATE_LIMIT_REASONS
+
+    def _backoff(self, attempt, error=None):
+        resp = getattr(error, 'resp', None)
+        retry_after = resp.get('retry-after') if hasattr(resp, 'get') else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_delay)
+            except ValueError:
+                pass
+        # Full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def execute(self, request):
+        """request.execute() をレート制限付きで実行する"""
+        attempt = 0
+        while True:
+            self.stats['throttle_sec'] += self.bucket.acquire()
+            self.stats['calls'] += 1
+            try:
+                return request.execute(num_retries=0)
+            except HttpError as e:
+                if attempt >= self.max_retries or not self._is_retryable(e):
+                    self.stats['errors'] += 1
+                    raise
+                delay = self._backoff(attempt, e)
+                self.log(f" [API制限] {e.resp.status} {_error_reason(e)} -> {delay:.1f}秒後に再試行")
+                time.sleep(delay)
+                self.stats['retries'] += 1
+                self.stats['throttle_sec'] += delay
+                attempt += 1
+            except TRANSPORT_ERRORS as e:
+                if attempt >= self.max_retries:
+                    self.stats['errors'] += 1
+                    raise
+                delay = self._backoff(attempt)
+                self.log(f" [通信エラー] {type(e).__name__} -> {delay:.1f}秒後に再試行")
+                time.sleep(delay)
+                self.stats['retries'] += 1
+                self.stats['throttle_sec'] += delay
+                attempt += 1
+
+    def insert_event(self, calendar_id, body):
+        """
+        body['id'] 付きで予定を挿入する。
+        409 は再試行の前に保存済みだったものとして扱い、削除済み (cancelled) なら元に戻す。
+        """
+        try:
+            return self.execute(self.service.events().insert(calendarId=calendar_id, body=body))
+        except HttpError as e:
+            if e.resp.status != 409:
+                raise
+        existing = self.execute(self.service.events().get(calendarId=calendar_id, eventId=body['id']))
+        if existing.get('status') == 'cancelled':
+            return self.execute(self.service.events().update(calendarId=calendar_id, eventId=body['id'], body=body))
+        return existing
+
+    def list_all(self, method, **kwargs):
+        """ページングを辿って items をすべて取得する"""
+        items, token = [], None
+        while True:
+            result = self.execute(method(pageToken=token, **kwargs) if token else method(**kwargs))
+            items.extend(result.get('items', []))
+            token = result.get('nextPageToken')
+            if not token:
+                return items
+
+    # --- 専用カレンダー管理 ---
+    def find_calendar(self, sig):
+        """
+        自ツールが作成した専用カレンダーのIDを探す (見つからなければNone)。
+        ユーザーが自分で作った同名のカレンダーを誤って使わないよう、説明文の sig だけで判定する。
+        """
+        for cal in self.list_all(self.service.calendarList().list, minAccessRole='owner'):
+            if not cal.get('primary') and cal.get('description') == sig:
+                return cal['id']
+        return None
+
+    def create_calendar(self, name, sig):
+        body = {'summary': name, 'description': sig, 'timeZone': 'Asia/Tokyo'}
+        return self.execute(self.service.calendars().insert(body=body))['id']
+
+    def migrate_events(self, source_id, dest_id, sig, time_min):
+        """time_min 以降の sig付きの予定を source から dest へ移動し、移動件数を返す"""
+        moved = 0
+        for ev in self.list_all(self.service.events().list, calendarId=source_id, q=sig, timeMin=time_min, singleEvents=True):
+            if ev.get('description') != sig or ev.get('recurringEventId'):
+                continue
+            self.execute(self.service.events().move(calendarId=source_id, eventId=ev['id'], destination=dest_id))
+            moved += 1
+        return moved
+
+    def reset_calendar(self, calendar_id, name, sig):
+        """
+        専用カレンダーを削除して作り直す。
+        calendars().clear はプライマリ専用のため、セカンダリは削除→再作成で一括消去する。
+        説明文が sig でないカレンダー (自ツールが作ったものではない) は削除しない。
+        """
+        cal = self.execute(self.service.calendars().get(calendarId=calendar_id))
+        if cal.get('description') != sig:
+            raise Exception(f"カレンダー「{cal.get('summary', calendar_id)}」は自動作成されたものではないため削除しません。")
+        self.execute(self.service.calendars().delete(calendarId=calendar_id))
+        return self.create_calendar(name, sig)
+
+    def summary(self):
+        s = self.stats
+        return f"API呼び出し {s['calls']}回 / 再試行 {s['retries']}回 / 待機 {s['throttle_sec']:.1f}秒 / 失敗 {s['errors']}回"
@@ -0,0 +1,191 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime as dt, timezone, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- ICSフィード出力 (Google Calendar APIを使わない出力モード) ---
+ICS_FILE = 'manaba.ics'
+JST = timezone(timedelta(hours=9))
+
+
+def _escape(text):
+    """iCalendarのTEXT値をエスケープ"""
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _fold(line):
+    """75オクテットごとに行を折り返す (RFC 5545 3.1)"""
+    raw = line.encode('utf-8')
+    if len(raw) <= 75:
+        return line
+    parts, current, size = [], '', 0
+    for ch in line:
+        n = len(ch.encode('utf-8'))
+        if size + n > (75 if not parts else 74):
+            parts.append(current)
+            current, size = '', 0
+        current += ch
+        size += n
+    parts.append(current)
+    return '\r\n '.join(parts)
+
+
+def _utc_stamp(value):
+    return value.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+class IcsFeed:
+    """
+    未提出課題の一覧を .ics ファイルとして書き出す。
+    VEVENTはUIDごとにキャッシュし、変化した課題だけを再生成する。
+    """
+    def __init__(self, path=ICS_FILE, sig="[manaba-auto]"):
+        self.path = path
+        self.cache_path = path + '.cache.json'
+        self.sig = sig
+        self.events = {}  # uid -> {'title', 'deadline', 'vevent'}
+        if os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path, 'r', encoding='utf-8') as f:
+                    self.events = json.load(f)
+            except (OSError, ValueError):
+                self.events = {}
+
+    @staticmethod
+    def make_uid(title, deadline):
+        digest = hashlib.sha1(f"{title}|{deadline}".encode('utf-8')).hexdigest()[:16]
+        return f"{digest}@manaba-calendar"
+
+    def _render_event(self, uid, title, deadline):
+        start = dt.fromisoformat(deadline).replace(tzinfo=JST)
+        lines = [
+            'BEGIN:VEVENT',
+            f'UID:{uid}',
+            f'DTSTAMP:{_utc_stamp(dt.now(timezone.utc))}',
+            f'DTSTART:{_utc_stamp(start)}',
+            f'DTEND:{_utc_stamp(start)}',
+            f'SUMMARY:{_escape(title)}',
+            f'DESCRIPTION:{_escape(self.sig)}',
+            'BEGIN:VALARM',
+            'ACTION:DISPLAY',
+            f'DESCRIPTION:{_escape(title)}',
+            'TRIGGER:-PT60M',
+            'END:VALARM',
+            'END:VEVENT',
+        ]
+        return '\r\n'.join(_fold(l) for l in lines)
+
+    def update(self, tasks, submitted_titles, keep=None):
+        """
+        課題一覧を反映する。戻り値は (追加, 継続, 削除) の件数。
+        keep(title) が True を返す予定は、今回の結果に無くても削除しない。
+        """
+        now = dt.now(JST).replace(tzinfo=None)
+        current = {}
+        for title, deadline in tasks:
+            current[self.make_uid(title, deadline)] = (title, deadline)
+
+        added = kept = removed = 0
+        for uid in list(self.events):
+            ev = self.events[uid]
+            expired = dt.fromisoformat(ev['deadline']) < now
+            done = ev['title'].split('：')[-1] in submitted_titles
+            if uid in current and not expired:
+                kept += 1
+                continue
+            if not expired and not done and keep and keep(ev['title']):
+                kept += 1
+                continue
+            del self.events[uid]
+            removed += 1
+
+        for uid, (title, deadline) in current.items():
+            if uid in self.events or dt.fromisoformat(deadline) < now:
+                continue
+            self.events[uid] = {'title': title, 'deadline': deadline,
+                                'vevent': self._render_event(uid, title, deadline)}
+            added += 1
+
+        if added or removed or not os.path.exists(self.path):
+            self._write()
+        return added, kept, removed
+
+    def render(self):
+        body = [ev['vevent'] for _, ev in sorted(self.events.items(), key=lambda x: (x[1]['deadline'], x[0]))]
+        head = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//manaba-calendar//JP',
+                'CALSCALE:GREGORIAN', 'X-WR-CALNAME:manaba 課題']
+        return '\r\n'.join(head + body + ['END:VCALENDAR']) + '\r\n'
+
+    def _write(self):
+        # 書きかけのファイルを配信しないよう、一時ファイル経由で置き換える
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8', newline='') as f:
+            f.write(self.render())
+        os.replace(tmp, self.path)
+        with open(self.cache_path, 'w', encoding='utf-8') as f:
+            json.dump(self.events, f, ensure_ascii=False)
+
+
+class _IcsHandler(BaseHTTPRequestHandler):
+    path_on_disk = ICS_FILE
+    _cache = {}  # (path, mtime_ns, size) -> (body, etag)
+
+    def _load(self):
+        st = os.stat(self.path_on_disk)
+        key = (self.path_on_disk, st.st_mtime_ns, st.st_size)
+        if key not in self._cache:
+            with open(self.path_on_disk, 'rb') as f:
+                body = f.read()
+            self._cache.clear()
+            self._cache[key] = (body, '"' + hashlib.sha1(body).hexdigest() + '"')
+        body, etag = self._cache[key]
+        return body, etag, int(st.st_mtime)
+
+    def do_GET(self, head_only=False):
+        try:
+            body, etag, mtime = self._load()
+        except OSError:
+            self.send_error(404)
+            return
+
+        not_modified = False
+        inm = self.headers.get('If-None-Match')
+        ims = self.headers.get('If-Modified-Since')
+        if inm is not None:
+            not_modified = etag in [t.strip() for t in inm.split(',')] or inm.strip() == '*'
+        elif ims:
+            try:
+                not_modified = int(parsedate_to_datetime(ims).timestamp()) >= mtime
+            except (TypeError, ValueError):
+                pass
+
+        self.send_response(304 if not_modified else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(mtime, usegmt=True))
+        self.send_header('Cache-Control', 'no-cache')
+        if not_modified:
+            self.end_headers()
+            return
+        self.send_header('Content-Type', 'text/calendar; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET(head_only=True)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_ics(path=ICS_FILE, host='127.0.0.1', port=8765):
+    """ICSファイルをローカルHTTPで配信する (バックグラウンドスレッド)"""
+    handler = type('IcsHandler', (_IcsHandler,), {'path_on_disk': path, '_cache': {}})
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -4,6 +4,7 @@ import base64
 import re
 import configparser
 import threading  # 追加: 非同期処理用
+import time
 import tkinter as tk
 from tkinter import messagebox, ttk
 from datetime import datetime as dt, timezone, timedelta
@@ -14,10 +15,19 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys
+from selenium.common.exceptions import TimeoutException
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 
+from browser_memory import MemoryGovernor, apply_lean_options
+from calendar_client import CalendarClient, MANAGED_CALENDAR, TRANSPORT_ERRORS, event_id
+from scan_budget import ScanBudget, BudgetExhausted, PAGE_TIMEOUT
+from scan_history import ScanHistory
+from scan_checkpoint import ScanCheckpoint, ScanCancelled
+from ics_feed import IcsFeed, serve_ics, ICS_FILE
+
 # --- 設定保存用 ---
 CONFIG_FILE = 'settings.ini'
 
@@ -35,17 +45,29 @@ def load_settings():
     return '', ''
 
 class ManabaEngine:
-    def __init__(self, user, pw, log_func, progress_func):
+    def __init__(self, user, pw, log_func, progress_func, output='calendar', dedicated=False, reset_calendar=False, time_budget=None, page_timeout=PAGE_TIMEOUT):
         self.user = user
         self.pw = pw
         self.log = log_func
         self.progress = progress_func
+        self.output = output  # 'calendar' または 'ics'
         self.calendar_id = 'primary'
+        self.dedicated = dedicated  # True: 専用カレンダーに同期
+        self.reset_calendar = reset_calendar
+        self.time_budget = time_budget  # スキャン全体の時間制限 (秒, Noneで無制限)
+        self.page_timeout = page_timeout
+        self.finished_courses = set()  # 最後まで解析できたコース名
+        self.scan_complete = True
         self.sig = "[manaba-auto]"
+        self.driver = None
+        self.cancel_event = threading.Event()
 
     def run(self):
         # 処理全体をtry-catchで囲み、最後に必ずドライバを閉じるようにする
-        driver = None
+        self.governor = MemoryGovernor()
+        self.checkpoint = ScanCheckpoint(self.user)
+        self.budget = ScanBudget(self.time_budget)
+        self.history = ScanHistory(self.user)
         try:
             self.log("--- 同期プロセス開始 ---")
             self.progress(5)
@@ -53,44 +75,117 @@ class ManabaEngine:
             # STEP1: manabaスキャン
             self.log("【1/2】manabaから課題を取得しています...")
             
-            # ブラウザ設定
-            options = webdriver.ChromeOptions()
-            options.add_argument('--lang=ja-JP')
-            # 画面を表示したくない場合は以下のコメントを外す
-            # options.add_argument('--headless') 
-            
-            driver = webdriver.Chrome(options=options)
-            tasks, submitted = self.fetch_manaba(driver)
+            self.driver = self._create_driver()
+            tasks, submitted = self.fetch_manaba()
             
             # ドライバーはここで用済みなので閉じる
-            driver.quit()
-            driver = None
+            self._quit_driver()
 
             self.log(f"-> 未提出課題: {len(tasks)}件、提出済み: {len(submitted)}件を検出")
+            self.log(f"-> {self.governor.summary()}")
             self.progress(60)
             
-            # STEP2: カレンダー同期
-            self.log("【2/2】Googleカレンダーと同期しています...")
-            self.sync_calendar(tasks, submitted)
+            # STEP2: カレンダー同期 / ICS出力
+            self._check_cancel()
+            if self.output == 'ics':
+                self.log("【2/2】ICSファイルを書き出しています...")
+                self.export_ics(tasks, submitted)
+            else:
+                self.log("【2/2】Googleカレンダーと同期しています...")
+                self.sync_calendar(tasks, submitted)
+            # 時間切れ等で残ったコースは、次回は同期済みのコースより先に巡回する
+            if self.scan_complete:
+                self.checkpoint.clear()
+            else:
+                # 同期した途中結果は次回再利用しない (残りのコースから先に巡回する)
+                self.checkpoint.mark_synced()
             
             self.progress(100)
             self.log("--- すべての工程が完了しました ---")
             messagebox.showinfo("完了", f"同期完了！\n未提出課題 {len(tasks)}件を整理しました。")
             
+        except ScanCancelled:
+            self.scan_complete = False
+            self.log("■ 中止しました (解析済みのコースは次回の同期で再利用されます)")
         except Exception as e:
+            self.scan_complete = False
             self.log(f"✖ エラーが発生しました: {e}")
+            if self.checkpoint.courses:
+                self.log(f"  解析済みの {len(self.checkpoint.courses)}コースは次回の同期で再利用されます")
             messagebox.showerror("エラー", str(e))
         finally:
-            if driver:
+            # 中止・エラー時もプログレスバーは止まった位置のまま残す
+            self._quit_driver()
+            self.history.save(self.scan_complete)
+
+    def cancel(self):
+        """中止要求 (UIスレッドから呼ばれる)。ブラウザを閉じて読み込み待ちも打ち切る"""
+        self.cancel_event.set()
+        self._quit_driver()
+
+    def _check_cancel(self):
+        if self.cancel_event.is_set():
+            raise ScanCancelled()
+
+    def _quit_driver(self):
+        driver, self.driver = self.driver, None
+        if driver:
+            try:
                 driver.quit()
-            self.progress(0)
+            except Exception:
+                pass
+
+    def _create_driver(self):
+        # ブラウザ設定
+        options = webdriver.ChromeOptions()
+        options.add_argument('--lang=ja-JP')
+        apply_lean_options(options)
+        # 画面を表示したくない場合は以下のコメントを外す
+        # options.add_argument('--headless') 
+        
+        return webdriver.Chrome(options=options)
+
+    def _visit(self, url):
+        """
+        ページを開き、ブラウザのメモリ使用量を記録する。
+        読み込みが page_timeout を超えたら一度だけ中断してやり直す。
+        """
+        for attempt in range(2):
+            self._check_cancel()
+            timeout = self.budget.timeout(self.page_timeout)
+            try:
+                self.driver.set_page_load_timeout(timeout)
+                self.driver.get(url)
+                break
+            except TimeoutException:
+                self._check_cancel()
+                if attempt == 1:
+                    raise
+                self.log(f" [遅延] {timeout:.0f}秒以内に読み込めなかったため再試行します")
+                try:
+                    self.driver.execute_script("window.stop();")
+                except Exception:
+                    pass
+            except Exception:
+                self._check_cancel()  # 中止でブラウザが閉じられた
+                raise
+        self.governor.sample(self.driver)
 
-    def fetch_manaba(self, driver):
+    def _recycle_driver(self):
+        """メモリ上限を超えたブラウザを作り直し、ログインし直す"""
+        self.log(f" [メモリ] {self.governor.last / 1024 / 1024:.0f}MB に達したためブラウザを再起動します")
+        self._quit_driver()
+        self.driver = self._create_driver()
+        self.governor.recycled()
+        self._login()
+
+    def _login(self):
+        driver = self.driver
         # Basic認証用ヘッダー
         auth = base64.b64encode(f"{self.user}:{self.pw}".encode()).decode()
         driver.execute_cdp_cmd("Network.setExtraHTTPHeaders", {"headers": {"Authorization": f"Basic {auth}"}})
         
-        driver.get('https://slms.mi.sanno.ac.jp/ct/home')
+        self._visit('https://slms.mi.sanno.ac.jp/ct/home')
         
         # ログイン処理（要素待機）
         try:
@@ -103,17 +198,34 @@ class ManabaEngine:
             pass # 既にログイン済み、あるいはBasic認証で通過した場合
 
         # ログイン成功判定（コース一覧があるか）
+        # 時間切れ (BudgetExhausted) をログイン失敗と区別するため、待ち時間は try の外で決める
+        timeout = self.budget.timeout(self.page_timeout)
         try:
-            WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.CSS_SELECTOR, 'td.course')))
+            WebDriverWait(driver, timeout).until(EC.presence_of_element_located((By.CSS_SELECTOR, 'td.course')))
         except:
+            self._check_cancel()
             raise Exception("manabaへのログインに失敗しました。ID/PWを確認してください。")
 
-        links = driver.find_elements(By.CSS_SELECTOR, 'td.course a[href*="course_"]:not(.courseweekly-fav)')
+    def fetch_manaba(self):
+        self._login()
+
+        links = self.driver.find_elements(By.CSS_SELECTOR, 'td.course a[href*="course_"]:not(.courseweekly-fav)')
         urls = list(dict.fromkeys([l.get_attribute('href') for l in links]))
         
+        # 履歴から未提出課題が出やすいコースを先に回す
+        history = self.history
+        urls = self.checkpoint.order(history.order(urls))
+        if history.full_sweep:
+            self.log(" [全巡回] 今回はすべてのページを確認します")
+        
         results = {}
         submitted_list = []
         targets = [('_report', 'レポート'), ('_query', '小テスト'), ('_survey', 'アンケート')]
+        checkpoint = self.checkpoint
+        self.finished_courses = set()
+        self.scan_complete = True
+        if checkpoint.courses:
+            self.log(f" [再開] 前回の途中結果 ({len(checkpoint.courses)}コース) から再開します")
 
         total = len(urls)
         for i, base_url in enumerate(urls):
@@ -121,32 +233,82 @@ class ManabaEngine:
             current_progress = 10 + (i / total * 50)
             self.progress(current_progress)
             
-            driver.get(base_url)
+            # チェックポイント済みのコースは前回の結果を使う
+            if base_url in checkpoint:
+                saved = checkpoint.get(base_url)
+                for key in saved['tasks']:
+                    results[tuple(key)] = 1
+                submitted_list.extend(saved['submitted'])
+                self.log(f" > 前回の結果を使用: {saved['name']}")
+                self.finished_courses.add(saved['name'])
+                continue
+            
+            if self.budget.exhausted():
+                self.scan_complete = False
+                break
+            
+            # 前のコースでメモリ上限を超えていたら、次のコースの前にブラウザを作り直す
+            if self.governor.over_limit():
+                try:
+                    self._recycle_driver()
+                except Exception as e:
+                    # 再起動・再ログインに失敗しても、解析済みのコースは同期する
+                    self._check_cancel()
+                    self.scan_complete = False
+                    if not isinstance(e, BudgetExhausted):
+                        self.log(f" [メモリ] ブラウザを再起動できませんでした ({e})。解析済みのコースで同期します")
+                    break
+            
+            driver = self.driver
             try:
+                self._visit(base_url)
                 name_elem = driver.find_elements(By.ID, 'coursename')
                 if not name_elem: continue
                 name = name_elem[0].text
                 
                 self.log(f" > 解析中: {name}")
                 
+                course_results = {}
+                course_submitted = []
                 for suffix, label in targets:
-                    driver.get(base_url + suffix)
+                    # これまで一度も課題が無かったページは飛ばす (全巡回の回を除く)
+                    if not history.should_visit(base_url, suffix):
+                        continue
+                    started = time.monotonic()
+                    self._visit(base_url + suffix)
                     rows = driver.find_elements(By.TAG_NAME, 'tr')
+                    dated_rows = 0
                     for row in rows:
                         t = row.text
                         m = re.findall(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}', t)
+                        if m: dated_rows += 1
                         
                         # 課題特定ロジック
                         if '未提出' in t and '受付中' in t and m:
                             deadline = sorted(m)[-1]
                             key = (f"【提出：{label}】{name}", deadline)
-                            results[key] = 1
+                            course_results[key] = 1
                         elif any(x in t for x in ['提出済み', '回答済み', '済']):
-                            submitted_list.append(f"{label}】{name}")
+                            course_submitted.append(f"{label}】{name}")
+                    history.record_page(base_url, suffix, dated_rows, time.monotonic() - started)
+                
+                # コースを最後まで解析できたら結果を確定してチェックポイントに保存
+                results.update(course_results)
+                submitted_list.extend(course_submitted)
+                checkpoint.save_course(base_url, name, list(course_results), course_submitted)
+                self.finished_courses.add(name)
+                history.record_course(base_url, name, len(course_results))
             except Exception as e:
+                self._check_cancel()
+                self.scan_complete = False
+                if isinstance(e, BudgetExhausted) or self.budget.exhausted():
+                    break
                 print(f"Error parsing course: {e}")
                 continue
         
+        if self.budget.exhausted():
+            self.log(f" [時間切れ] {len(self.finished_courses)}/{total}コースの結果で同期します (未完了のコースの予定は削除しません)")
+        
         final_tasks = [(t, dt.strptime(d, '%Y-%m-%d %H:%M').strftime("%Y-%m-%dT%H:%M:00")) for t, d in results.keys()]
         return final_tasks, list(set(submitted_list))
 
@@ -175,17 +337,42 @@ class ManabaEngine:
         
         return build('calendar', 'v3', credentials=creds)
 
+    def _prepare_calendar(self, api):
+        """専用カレンダーを使う場合はそのIDを解決する (初回は作成してprimaryから移行)"""
+        if not self.dedicated:
+            return
+        cal_id = api.find_calendar(self.sig)
+        if cal_id is None:
+            cal_id = api.create_calendar(MANAGED_CALENDAR, self.sig)
+            self.log(f">> 専用カレンダー「{MANAGED_CALENDAR}」を作成しました")
+            
+            # 作成時に一度だけ、メインカレンダーに残っている [manaba-auto] の予定を移行
+            # (sync_calendar と同じく過去60日より前の予定は対象外)
+            time_min = (dt.now(timezone.utc) - timedelta(days=60)).isoformat()
+            moved = api.migrate_events('primary', cal_id, self.sig, time_min)
+            if moved:
+                self.log(f">> メインカレンダーから {moved}件の予定を移行しました")
+        elif self.reset_calendar and not self.scan_complete:
+            # 解析できなかったコースの予定まで消えてしまうため、途中で打ち切ったスキャンでは作り直さない
+            self.log(">> スキャンが完了していないため、専用カレンダーの作り直しをスキップしました")
+        elif self.reset_calendar:
+            cal_id = api.reset_calendar(cal_id, MANAGED_CALENDAR, self.sig)
+            self.log(f">> 専用カレンダー「{MANAGED_CALENDAR}」を作り直しました")
+        self.calendar_id = cal_id
+
     def sync_calendar(self, tasks, submitted_titles):
         service = self._get_calendar_service()
+        api = CalendarClient(service, self.log)
+        self._prepare_calendar(api)
         now = dt.now(timezone.utc)
         
         self.log(">> 既存の予定を確認中...")
-        events_result = service.events().list(
+        events = api.list_all(
+            service.events().list,
             calendarId=self.calendar_id, 
             timeMin=(now - timedelta(days=60)).isoformat(), 
             singleEvents=True
-        ).execute()
-        events = events_result.get('items', [])
+        )
         
         processed_keys = {}
         for ev in events:
@@ -201,11 +388,18 @@ class ManabaEngine:
                 ev_dt = dt.fromisoformat(ev_dt_str.replace('Z', '+00:00'))
                 
                 # 提出済み、または期限切れの予定を削除
-                if category_with_name in submitted_titles or ev_dt < now:
+                # (時間切れで解析できなかったコースの予定は提出済み扱いにしない)
+                if (category_with_name in submitted_titles and not self._is_unfinished(summary)) or ev_dt < now:
                     try:
-                        service.events().delete(calendarId=self.calendar_id, eventId=ev['id']).execute()
+                        api.execute(service.events().delete(calendarId=self.calendar_id, eventId=ev['id']))
                         self.log(f" [削除済/期限切れ] {summary}")
-                    except: pass
+                    except HttpError as e:
+                        # 404/410 は既に削除済み
+                        if e.resp.status not in (404, 410):
+                            self.log(f" [削除失敗] {summary}: {e}")
+                    except TRANSPORT_ERRORS as e:
+                        # 再試行しても通信できなかった予定は次回の同期で削除する
+                        self.log(f" [削除失敗] {summary}: {e}")
                     continue
             
             # 重複チェック用キー
@@ -226,16 +420,29 @@ class ManabaEngine:
                     'colorId': '11', # 赤色(目立つように)
                     'reminders': {'useDefault': False, 'overrides': [{'method': 'popup', 'minutes': 60}]}
                 }
-                service.events().insert(calendarId=self.calendar_id, body=event).execute()
+                event['id'] = event_id(title, deadline)
+                api.insert_event(self.calendar_id, event)
                 self.log(f" [新規追加] {title}")
             else:
                  self.log(f" [継続] {title}")
+        
+        self.log(f">> {api.summary()}")
+
+    def _is_unfinished(self, title):
+        """途中で打ち切ったスキャンで、解析できなかったコースの予定か"""
+        return not self.scan_complete and title.split('】')[-1] not in self.finished_courses
+
+    def export_ics(self, tasks, submitted_titles):
+        feed = IcsFeed(ICS_FILE, sig=self.sig)
+        added, kept, removed = feed.update(tasks, submitted_titles, keep=self._is_unfinished)
+        self.log(f" [ICS] 追加 {added}件 / 継続 {kept}件 / 削除 {removed}件")
+        self.log(f" -> {os.path.abspath(ICS_FILE)}")
 
 class SimpleApp:
     def __init__(self, root):
         self.root = root
         self.root.title("manaba 同期ツール (Thread版)")
-        self.root.geometry("480x600")
+        self.root.geometry("480x720")
         
         frame = tk.Frame(root, pady=15)
         frame.pack()
@@ -252,8 +459,28 @@ class SimpleApp:
         self.ent_user.insert(0, u)
         self.ent_pw.insert(0, p)
         
+        # 出力先: Googleカレンダー or ICSファイル (ローカル配信)
+        self.var_ics = tk.BooleanVar(value=False)
+        tk.Checkbutton(frame, text="ICSファイルに出力 (Google API不使用)", variable=self.var_ics, font=("Yu Gothic", 9)).grid(row=2, column=0, columnspan=2, pady=2)
+        self.ics_server = None
+        
+        # 同期先: 専用カレンダー「manaba」
+        self.var_dedicated = tk.BooleanVar(value=False)
+        tk.Checkbutton(frame, text=f"専用カレンダー「{MANAGED_CALENDAR}」に同期", variable=self.var_dedicated, font=("Yu Gothic", 9)).grid(row=3, column=0, columnspan=2, pady=2)
+        self.var_reset = tk.BooleanVar(value=False)
+        tk.Checkbutton(frame, text="専用カレンダーを作り直す", variable=self.var_reset, font=("Yu Gothic", 9)).grid(row=4, column=0, columnspan=2, pady=2)
+        
+        # スキャンの時間制限 (空欄なら無制限)
+        tk.Label(frame, text="時間制限(秒):", font=("Yu Gothic", 10)).grid(row=5, column=0, sticky="e", padx=5)
+        self.ent_budget = tk.Entry(frame, width=8, font=("Consolas", 10))
+        self.ent_budget.grid(row=5, column=1, sticky="w", pady=2)
+        
         self.btn = tk.Button(root, text="同期を開始", command=self.start_thread, width=25, height=2, bg="#4CAF50", fg="white", font=("Yu Gothic", 10, "bold"))
-        self.btn.pack(pady=10)
+        self.btn.pack(pady=(10, 2))
+        
+        self.btn_cancel = tk.Button(root, text="中止", command=self.cancel, width=25, state=tk.DISABLED, font=("Yu Gothic", 9))
+        self.btn_cancel.pack(pady=(0, 10))
+        self.engine = None
         
         self.pb = ttk.Progressbar(root, length=400, mode='determinate')
         self.pb.pack(pady=5)
@@ -292,23 +519,47 @@ class SimpleApp:
         
         # UIロック
         self.btn.config(state=tk.DISABLED, bg="#9E9E9E", text="実行中...")
+        self.btn_cancel.config(state=tk.NORMAL, text="中止")
         self.log_box.delete('1.0', tk.END)
         
+        output = 'ics' if self.var_ics.get() else 'calendar'
+        cal_opts = {'dedicated': self.var_dedicated.get(), 'reset_calendar': self.var_reset.get()}
+        self.var_reset.set(False)
+        budget = self.ent_budget.get().strip()
+        time_budget = int(budget) if budget.isdigit() and int(budget) > 0 else None
+        self.engine = ManabaEngine(user, pw, self.add_log, self.set_progress, output=output, time_budget=time_budget, **cal_opts)
+        
         # スレッド開始
-        thread = threading.Thread(target=self.run_logic, args=(user, pw))
+        thread = threading.Thread(target=self.run_logic, args=(output,))
         thread.daemon = True # アプリ終了時に強制終了できるようにする
         thread.start()
 
-    def run_logic(self, user, pw):
+    def cancel(self):
+        """ 中止ボタン: ブラウザを閉じてスキャンを打ち切る """
+        if self.engine:
+            self.btn_cancel.config(state=tk.DISABLED, text="中止しています...")
+            threading.Thread(target=self.engine.cancel, daemon=True).start()
+
+    def run_logic(self, output):
         """ 別スレッドで動く実処理 """
-        engine = ManabaEngine(user, pw, self.add_log, self.set_progress)
-        engine.run()
+        self.engine.run()
+        
+        # ICSモードではカレンダーアプリから購読できるようローカル配信する
+        if output == 'ics' and self.ics_server is None and os.path.exists(ICS_FILE):
+            try:
+                self.ics_server = serve_ics(ICS_FILE)
+                host, port = self.ics_server.server_address[:2]
+                self.add_log(f" [ICS配信] http://{host}:{port}/manaba.ics")
+            except OSError as e:
+                self.add_log(f" [ICS配信] 開始できませんでした: {e}")
         
         # 処理が終わったらボタンを戻す
         self.root.after(0, self.reset_ui)
 
     def reset_ui(self):
+        self.engine = None
         self.btn.config(state=tk.NORMAL, bg="#4CAF50", text="同期を開始")
+        self.btn_cancel.config(state=tk.DISABLED, text="中止")
 
 if __name__ == "__main__":
     root = tk.Tk()
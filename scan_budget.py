@@ -0,0 +1,33 @@
+import time
+
+# --- スキャンの時間制限 ---
+# 1ページの読み込みを待つ上限 (秒)
+PAGE_TIMEOUT = 20
+
+
+class BudgetExhausted(Exception):
+    """スキャン全体の時間制限に達した"""
+
+
+class ScanBudget:
+    """スキャン全体の残り時間を管理する (seconds=None で無制限)"""
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds if seconds else None
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def exhausted(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def timeout(self, page_timeout):
+        """1ページに使える待ち時間 (残り時間を超えない)。残りが無ければ BudgetExhausted"""
+        remaining = self.remaining()
+        if remaining is None:
+            return page_timeout
+        if remaining < 1:
+            raise BudgetExhausted("スキャンの時間制限に達しました")
+        return min(page_timeout, remaining)
@@ -0,0 +1,69 @@
+import os
+import json
+import time
+import hashlib
+
+# --- スキャンの途中経過 (チェックポイント) ---
+# これより古いチェックポイントは使わずに最初からスキャンする (秒)
+CHECKPOINT_MAX_AGE = 2 * 3600
+
+
+class ScanCancelled(Exception):
+    """ユーザーが中止ボタンを押した"""
+
+
+class ScanCheckpoint:
+    """
+    コースごとの解析結果をJSONに書き出しておき、
+    クラッシュや中止の後に次回のスキャンで再利用する。
+    時間切れ等で途中まで同期した結果は再利用せず (提出状況が変わっている可能性があるため)、
+    同期済みのコースを次回の巡回順の最後に回すだけにする。
+    """
+    def __init__(self, user, path=None, max_age=CHECKPOINT_MAX_AGE):
+        self.path = path or f"checkpoint_{hashlib.sha1(user.encode()).hexdigest()[:12]}.json"
+        self.courses = {}  # base_url -> {'name', 'tasks': [[title, deadline]], 'submitted': [...]}
+        self.synced = set()  # 同期済みのコースの base_url
+        self.started = time.time()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if time.time() - data.get('started', 0) <= max_age:
+                    self.courses = data.get('courses', {})
+                    self.synced = set(data.get('synced', []))
+                    self.started = data['started']
+            except (OSError, ValueError, KeyError):
+                self.courses = {}
+                self.synced = set()
+
+    def __contains__(self, base_url):
+        return base_url in self.courses
+
+    def get(self, base_url):
+        return self.courses[base_url]
+
+    def order(self, urls):
+        """前回同期済みのコースを後ろに回す (それ以外の順序は保つ)"""
+        return sorted(urls, key=lambda url: url in self.synced)
+
+    def save_course(self, base_url, name, tasks, submitted):
+        self.courses[base_url] = {'name': name, 'tasks': [list(t) for t in tasks], 'submitted': list(submitted)}
+        self._write()
+
+    def mark_synced(self):
+        """解析済みのコースを同期済みにし、次回は結果を使わずに巡回し直す"""
+        self.synced.update(self.courses)
+        self.courses = {}
+        self._write()
+
+    def _write(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'started': self.started, 'courses': self.courses, 'synced': sorted(self.synced)}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        self.courses = {}
+        self.synced = set()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import hashlib
+
+# --- コースごとのスキャン履歴 (巡回順の最適化) ---
+# 何回に1回は履歴を無視して全ページを巡回する
+FULL_SWEEP_EVERY = 5
+# 最後の全巡回からこれ以上経ったら全ページを巡回する (秒)
+FULL_SWEEP_MAX_AGE = 7 * 24 * 3600
+# この回数以上続けて空だったページは、全巡回以外では開かない
+MIN_EMPTY_VISITS = 3
+
+
+class ScanHistory:
+    """
+    コース・ページごとに「課題の行があったか」「未提出課題が出た頻度」「読み込み時間」を記録し、
+    次回のスキャン順と開くページを決める。
+    """
+    def __init__(self, user, path=None):
+        self.path = path or f"history_{hashlib.sha1(user.encode()).hexdigest()[:12]}.json"
+        self.data = {'runs': 0, 'last_full': 0, 'courses': {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.data.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+        self.full_sweep = (self.data['runs'] % FULL_SWEEP_EVERY == 0
+                           or time.time() - self.data['last_full'] > FULL_SWEEP_MAX_AGE)
+
+    def _course(self, base_url):
+        return self.data['courses'].setdefault(base_url, {'name': '', 'scans': 0, 'open_hits': 0, 'pages': {}})
+
+    def _score(self, base_url):
+        c = self.data['courses'].get(base_url)
+        if not c:
+            return (-0.5, 0.0)  # 初めてのコースは中くらいの優先度
+        open_rate = (c['open_hits'] + 1) / (c['scans'] + 2)
+        load = sum(p['avg_sec'] for p in c['pages'].values())
+        return (-open_rate, load)
+
+    def order(self, urls):
+        """未提出課題が出やすいコース → 読み込みが速いコースの順に並べる"""
+        return sorted(urls, key=self._score)
+
+    def should_visit(self, base_url, suffix):
+        if self.full_sweep:
+            return True
+        page = self.data['courses'].get(base_url, {}).get('pages', {}).get(suffix)
+        return not page or page['rows'] > 0 or page['visits'] < MIN_EMPTY_VISITS
+
+    def record_page(self, base_url, suffix, rows, seconds):
+        page = self._course(base_url)['pages'].setdefault(suffix, {'visits': 0, 'rows': 0, 'avg_sec': 0.0})
+        page['visits'] += 1
+        page['rows'] += rows
+        # 読み込み時間は指数移動平均
+        page['avg_sec'] = seconds if page['visits'] == 1 else page['avg_sec'] * 0.7 + seconds * 0.3
+
+    def record_course(self, base_url, name, open_count):
+        c = self._course(base_url)
+        c['name'] = name
+        c['scans'] += 1
+        if open_count:
+            c['open_hits'] += 1
+
+    def save(self, complete):
+        """
+        履歴を書き出す。回数と全巡回の時刻は、スキャンが最後まで終わった回だけ進める
+        (中止・エラー・時間切れの全巡回は、次回にもう一度全巡回する)。
+        """
+        if complete:
+            self.data['runs'] += 1
+            if self.full_sweep:
+                self.data['last_full'] = time.time()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
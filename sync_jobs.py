@@ -0,0 +1,156 @@
+import hashlib
+import heapq
+import hmac
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+
+# --- バックグラウンド同期ジョブ (Streamlit版) ---
+# 同時に起動するChromiumの上限。メモリの少ないホストでは1にする
+MAX_BROWSER_SLOTS = int(os.environ.get('MANABA_BROWSER_SLOTS', '2'))
+# 実績が無いときの所要時間の見積もり (秒)
+DEFAULT_JOB_SECONDS = 90
+# 終了したジョブを保持する時間 (秒)
+JOB_TTL = 3600
+
+
+class SyncJob:
+    """1回分の同期処理。ログと進捗はワーカースレッドから書き込み、画面側がポーリングで読む"""
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'  # queued / running / done / error / cancelled
+        self.logs = []
+        self.progress = 0
+        self.result = None   # 完了時のメッセージ
+        self.error = None
+        self.memory = None   # ブラウザのメモリ統計 (browser_memory.MemoryGovernor.stats)
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+        self.on_cancel = None  # 実行中のエンジンが登録する (ブラウザを閉じる)
+        # 開始した本人の確認用 (manabaのID・パスワードのソルト付きハッシュ)
+        self.salt = os.urandom(16)
+        self.owner = None
+
+    def _digest(self, user_id, password):
+        return hashlib.sha256(self.salt + f"{user_id}\0{password}".encode('utf-8')).hexdigest()
+
+    def set_owner(self, user_id, password):
+        self.owner = self._digest(user_id, password)
+
+    def is_owner(self, user_id, password):
+        """ジョブを開始したときと同じ manaba のID・パスワードか"""
+        return self.owner is not None and hmac.compare_digest(self.owner, self._digest(user_id, password))
+
+    def log(self, message):
+        timestamp = dt.now().strftime("%H:%M:%S")
+        with self.lock:
+            self.logs.append(f"[{timestamp}] {message}")
+        print(f"[{timestamp}] {message}")
+
+    def set_progress(self, value):
+        self.progress = int(value)
+
+    def cancel(self):
+        """中止要求。待機中ならそのまま取り消し、実行中ならエンジンに打ち切らせる"""
+        self.cancel_event.set()
+        if self.status == 'queued':
+            # 待ち順やETAの計算から外す (ワーカーに渡ったときは _run がそのまま終了する)
+            self.status = 'cancelled'
+            self.finished_at = time.time()
+        if self.on_cancel:
+            self.on_cancel()
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+
+class JobQueue:
+    """プロセス全体で共有するワーカーキュー。slots の数だけブラウザを同時に動かす"""
+    def __init__(self, slots=MAX_BROWSER_SLOTS):
+        self.slots = slots
+        self.executor = ThreadPoolExecutor(max_workers=slots, thread_name_prefix='manaba-sync')
+        self.jobs = OrderedDict()
+        self.durations = deque(maxlen=20)
+        self.lock = threading.Lock()
+
+    def submit(self, target, user_id, password):
+        """target(job) をバックグラウンドで実行するジョブを登録する (ID・パスワードは本人確認用)"""
+        job = SyncJob()
+        job.set_owner(user_id, password)
+        with self.lock:
+            self._prune()
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job, target)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _run(self, job, target):
+        job.started_at = time.time()
+        if job.cancel_event.is_set():
+            job.status = 'cancelled'
+            job.finished_at = job.started_at
+            return
+        job.status = 'running'
+        try:
+            target(job)
+            if job.status == 'running':
+                job.status = 'done'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'error'
+        finally:
+            job.finished_at = time.time()
+            self.durations.append(job.finished_at - job.started_at)
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [k for k, j in self.jobs.items() if j.finished_at and now - j.finished_at > JOB_TTL]:
+            del self.jobs[job_id]
+
+    def _average(self):
+        return sum(self.durations) / len(self.durations) if self.durations else DEFAULT_JOB_SECONDS
+
+    def position(self, job):
+        """自分より前に待っているジョブの数 (実行中なら0)"""
+        if job.status != 'queued':
+            return 0
+        with self.lock:
+            queued = [j for j in self.jobs.values() if j.status == 'queued']
+        return queued.index(job) if job in queued else 0
+
+    def eta(self, job):
+        """完了までの残り秒数の見積もり"""
+        avg = self._average()
+        now = time.time()
+        if job.status == 'running':
+            elapsed = now - job.started_at
+            if job.progress > 5:
+                return max(elapsed / job.progress * (100 - job.progress), 0)
+            return max(avg - elapsed, 0)
+        if job.status != 'queued':
+            return 0
+
+        with self.lock:
+            running = [j for j in self.jobs.values() if j.status == 'running']
+            queued = [j for j in self.jobs.values() if j.status == 'queued']
+        # 各スロットが空く時刻をシミュレートする
+        free_at = [max(avg - (now - j.started_at), 0) for j in running][:self.slots]
+        free_at += [0.0] * (self.slots - len(free_at))
+        heapq.heapify(free_at)
+        for j in queued:
+            start = heapq.heappop(free_at)
+            if j is job:
+                return start + avg
+            heapq.heappush(free_at, start + avg)
+        return avg